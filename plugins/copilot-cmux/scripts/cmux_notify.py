@@ -1,76 +1,144 @@
 #!/usr/bin/env python3
+import functools
+import hashlib
 import json
 import os
+import re
 import shutil
+import socket
+import stat
 import subprocess
 import sys
 import tempfile
+import time
+from collections import deque
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 MAX_BODY_LENGTH = 180
-INTERACTIVE_TOOL_NAMES = {"ask_user", "exit_plan_mode"}
+_WORD_RE = re.compile(r"\S+")
+# The same line boundaries str.splitlines() uses.
+_LINE_BREAK_RE = re.compile("[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+INTERACTIVE_TOOL_NAMES = frozenset({"ask_user", "exit_plan_mode"})
+TOOL_EVENTS = frozenset({"preToolUse", "postToolUse"})
+SESSION_TITLE_KEYS = ("sessionTitle", "session_title", "sessionName", "session_name")
+WORKING_DIRECTORY_KEYS = (
+    "cwd",
+    "workingDirectory",
+    "working_directory",
+    "projectPath",
+    "project_path",
+    "workspacePath",
+    "workspace_path",
+    "directory",
+)
+STATE_TITLE_SIZE = 256
+STATE_FILE_SIZE = 1 + STATE_TITLE_SIZE + 1
+STATE_FLAG_STARTED = 0x01
+CLAUDE_HOOK_STDIN = b"{}"
+# How a cmux without the `batch` subcommand rejects it: a usage-error exit
+# status or an "unknown command" message.
+CMUX_USAGE_EXIT = 2
+_UNKNOWN_COMMAND_RE = re.compile(rb"unknown (sub)?command|usage:", re.IGNORECASE)
+RUNNING_STATUS_ARGS = ("set-status", "running", "Running", "--color", "#34c759", "--icon", "bolt.fill")
+
+
+def json_loads(data):
+    """Decode JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # stdlib json accepts a few inputs orjson rejects (e.g. NaN)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    """Encode compact JSON to bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
 
 
 def parse_hook_payload() -> dict:
-    raw = sys.stdin.read()
+    raw = sys.stdin.buffer.read()
     if not raw.strip():
         return {}
     try:
-        data = json.loads(raw)
-    except json.JSONDecodeError as error:
+        data = json_loads(raw)
+    except ValueError as error:
         print(f"cmux-notify: invalid hook payload: {error}", file=sys.stderr)
         return {}
     return data if isinstance(data, dict) else {}
 
 
 def normalize_body(text: str) -> str:
-    return " ".join(text.split())[:MAX_BODY_LENGTH]
-
-
-def find_first_string(payload: dict, keys: tuple[str, ...]) -> str:
-    stack = [payload]
+    """Collapse whitespace and truncate, scanning only as far as the limit."""
+    words = []
+    length = -1
+    for match in _WORD_RE.finditer(text):
+        word = match.group()
+        words.append(word)
+        length += len(word) + 1
+        if length >= MAX_BODY_LENGTH:
+            break
+    return " ".join(words)[:MAX_BODY_LENGTH]
+
+
+def _iter_dicts(root):
+    """Yield every dict nested in root (through dicts and lists), depth-first."""
+    if not isinstance(root, dict):
+        return
+    stack = deque((root,))
+    pop = stack.pop
+    append = stack.append
     while stack:
-        current = stack.pop()
-        if not isinstance(current, dict):
-            continue
-
-        for key in keys:
-            value = current.get(key)
-            if isinstance(value, str):
-                value = value.strip()
-                if value:
-                    return value
-
+        current = pop()
+        yield current
         for value in current.values():
             if isinstance(value, dict):
-                stack.append(value)
+                append(value)
             elif isinstance(value, list):
                 for item in value:
                     if isinstance(item, dict):
-                        stack.append(item)
-    return ""
-
-
-def extract_session_title(payload: dict) -> str:
-    return find_first_string(
+                        append(item)
+
+
+def find_strings(payload: dict, groups: dict[str, tuple[str, ...]]) -> dict[str, str]:
+    """Find the first non-empty string for each key group in one payload walk."""
+    found = {}
+    pending = dict(groups)
+    for node in _iter_dicts(payload):
+        get = node.get
+        for group, keys in list(pending.items()):
+            for key in keys:
+                value = get(key)
+                if isinstance(value, str) and (value := value.strip()):
+                    found[group] = value
+                    del pending[group]
+                    break
+        if not pending:
+            break
+    return found
+
+
+def extract_context(payload: dict) -> tuple[str, str]:
+    """Return (session_title, working_directory) from a single payload walk.
+
+    The working directory is "" when the payload has none; the environment
+    fallback lives in resolve_working_directory.
+    """
+    found = find_strings(
         payload,
-        ("sessionTitle", "session_title", "sessionName", "session_name"),
+        {"session_title": SESSION_TITLE_KEYS, "working_directory": WORKING_DIRECTORY_KEYS},
     )
+    return found.get("session_title", ""), found.get("working_directory", "")
 
 
-def extract_working_directory(payload: dict) -> str:
-    directory = find_first_string(
-        payload,
-        (
-            "cwd",
-            "workingDirectory",
-            "working_directory",
-            "projectPath",
-            "project_path",
-            "workspacePath",
-            "workspace_path",
-            "directory",
-        ),
-    )
+def resolve_working_directory(directory: str) -> str:
     if directory:
         return directory
 
@@ -83,8 +151,7 @@ def extract_working_directory(payload: dict) -> str:
         return ""
 
 
-def extract_project_name(payload: dict) -> str:
-    directory = extract_working_directory(payload)
+def project_name_from_directory(directory: str) -> str:
     if not directory:
         return ""
     normalized = os.path.normpath(directory)
@@ -92,25 +159,71 @@ def extract_project_name(payload: dict) -> str:
     return project_name or normalized
 
 
-def build_context_subtitle(payload: dict) -> str:
-    session_title = extract_session_title(payload)
-    project_name = extract_project_name(payload)
+def build_context_subtitle(session_title: str, project_name: str) -> str:
     if session_title and project_name:
         return normalize_body(f"{session_title} — {project_name}")
     return normalize_body(session_title or project_name)
 
 
+def build_workspace_title(session_title: str, project_name: str) -> str:
+    if session_title and project_name:
+        return f"{project_name} — {session_title}"
+    return project_name or session_title or ""
+
+
+class HookCtx:
+    """Payload-derived strings, computed on first use and reused for the hook.
+
+    Nothing is extracted until a field is read, so paths that never show a
+    title or notification never walk the payload or fall back to os.getcwd().
+    """
+
+    def __init__(self, payload: dict):
+        self._payload = payload
+
+    @functools.cached_property
+    def _context(self) -> tuple[str, str]:
+        return extract_context(self._payload)
+
+    @functools.cached_property
+    def session_title(self) -> str:
+        return self._context[0]
+
+    @functools.cached_property
+    def project_name(self) -> str:
+        return project_name_from_directory(resolve_working_directory(self._context[1]))
+
+    @functools.cached_property
+    def workspace_title(self) -> str:
+        return build_workspace_title(self.session_title, self.project_name)
+
+    @functools.cached_property
+    def context_subtitle(self) -> str:
+        return build_context_subtitle(self.session_title, self.project_name)
+
+
+@functools.lru_cache(maxsize=1)
 def resolve_cmux_binary():
     preferred_cmux = "/Applications/cmux.app/Contents/Resources/bin/cmux"
-    if os.path.isfile(preferred_cmux) and os.access(preferred_cmux, os.X_OK):
+    try:
+        mode = os.stat(preferred_cmux).st_mode
+    except OSError:
+        mode = 0
+    if stat.S_ISREG(mode) and mode & 0o111:
         return preferred_cmux
     return shutil.which("cmux")
 
 
+@functools.lru_cache(maxsize=1)
+def resolve_osascript_binary():
+    return shutil.which("osascript")
+
+
 def _safe_filename(text: str) -> str:
     return text.replace("/", "_").replace(":", "_").replace(" ", "_")
 
 
+@functools.lru_cache(maxsize=1)
 def get_workspace_ref() -> str:
     for key in ("CMUX_WORKSPACE_ID", "CMUX_WORKSPACE_REF"):
         value = os.environ.get(key)
@@ -119,35 +232,116 @@ def get_workspace_ref() -> str:
     return ""
 
 
+@functools.lru_cache(maxsize=1)
+def use_json_state() -> bool:
+    """Return True when CMUX_COPILOT_JSON_STATE asks for the legacy JSON state file."""
+    value = os.environ.get("CMUX_COPILOT_JSON_STATE", "").strip().lower()
+    return value not in ("", "0", "false", "no")
+
+
+@functools.lru_cache(maxsize=1)
 def state_file_path() -> str:
     ref = get_workspace_ref()
     if not ref:
         return ""
     safe = _safe_filename(ref)
-    return os.path.join(tempfile.gettempdir(), f"cmux-copilot-{safe}.json")
+    extension = "json" if use_json_state() else "state"
+    return os.path.join(tempfile.gettempdir(), f"cmux-copilot-{safe}.{extension}")
+
+
+@functools.lru_cache(maxsize=1)
+def hook_agent_socket_path() -> str:
+    ref = get_workspace_ref()
+    if not ref:
+        return ""
+    safe = _safe_filename(ref)
+    return os.path.join(tempfile.gettempdir(), f"cmux-copilot-{safe}.sock")
+
+
+def stored_state_title(title: str) -> str:
+    """Return title as it reads back from the state file (flat files truncate it)."""
+    if use_json_state():
+        return title
+    return title.encode()[:STATE_TITLE_SIZE].decode(errors="ignore")
 
 
 def read_state() -> dict:
     path = state_file_path()
     if not path:
         return {}
+    if use_json_state():
+        return _read_json_state(path)
     try:
-        with open(path) as f:
-            data = json.load(f)
-        return data if isinstance(data, dict) else {}
-    except (OSError, json.JSONDecodeError):
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return {}
+    try:
+        record = os.read(fd, STATE_FILE_SIZE)
+    except OSError:
+        return {}
+    finally:
+        os.close(fd)
+    if len(record) < STATE_FILE_SIZE:
         return {}
 
+    flags = record[0]
+    title = record[1 : 1 + STATE_TITLE_SIZE].split(b"\0", 1)[0]
+    state = {"started": bool(flags & STATE_FLAG_STARTED)}
+    if title:
+        state["title"] = title.decode(errors="ignore")
+    return state
+
 
 def write_state(state: dict) -> None:
+    """Write the full fixed-layout state record and atomically swap it in.
+
+    Layout: byte 0 holds the STATE_FLAG_* bits, the next STATE_TITLE_SIZE
+    bytes hold the NUL-padded UTF-8 title, and the file ends with a newline.
+    """
     path = state_file_path()
     if not path:
         return
+    if use_json_state():
+        _write_json_state(path, state)
+        return
+    title = stored_state_title(str(state.get("title") or "")).encode()
+    flags = 0
+    if state.get("started"):
+        flags |= STATE_FLAG_STARTED
+    _replace_file(path, bytes((flags,)) + title.ljust(STATE_TITLE_SIZE, b"\0") + b"\n")
+
+
+def _read_json_state(path: str) -> dict:
+    try:
+        with open(path, "rb") as f:
+            data = json_loads(f.read())
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json_state(path: str, state: dict) -> None:
+    _replace_file(path, json_dumps(state))
+
+
+def _replace_file(path: str, data: bytes) -> None:
+    """Atomically replace path with data; durability (fsync) is not needed.
+
+    The temp name is per-process so concurrent hooks never share one.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        with open(path, "w") as f:
-            json.dump(state, f)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
     except OSError:
-        pass
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
 
 
 def remove_state() -> None:
@@ -159,74 +353,187 @@ def remove_state() -> None:
             pass
 
 
-def update_workspace_title(cmux: str, title: str) -> bool:
+def _spawn_detached(cmd: list[str], input: str = "") -> bool:
+    """Start cmd in its own session without waiting for it to exit.
+
+    Returns True once the process has been forked; the exit status is never
+    collected, so only use this for fire-and-forget status updates.
+    """
     try:
-        result = subprocess.run(
-            [cmux, "rename-workspace", title],
-            check=False,
-            capture_output=True,
-            timeout=3,
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if input else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
         )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
+    except OSError:
         return False
+    if input:
+        try:
+            process.stdin.write(input.encode())
+            process.stdin.close()
+        except OSError:
+            pass
+    return True
+
 
+def _op_stdin(op: list[str]) -> bytes:
+    """`cmux claude-hook` reads a JSON hook payload on stdin; other ops read nothing."""
+    return CLAUDE_HOOK_STDIN if op[0] == "claude-hook" else b""
 
-def update_workspace_subtitle(cmux: str, message: str) -> bool:
-    """Update sidebar intent status silently via set-status."""
-    cmd = [cmux, "set-status", "intent", message]
+
+def _op_message(op: list[str]) -> dict:
+    message = {"args": op}
+    stdin = _op_stdin(op)
+    if stdin:
+        message["stdin"] = stdin.decode()
+    return message
+
+
+def _open_hook_agent_socket(path: str):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        result = subprocess.run(
-            cmd,
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+        sock.settimeout(0.5)
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 
-def clear_workspace_subtitle(cmux: str) -> bool:
-    """Clear intent status from sidebar."""
+@functools.lru_cache(maxsize=1)
+def _connect_hook_agent():
+    """Connect to the persistent `cmux hook-agent`; returns None if it is not running."""
+    path = hook_agent_socket_path()
+    if not path or not os.path.exists(path):
+        return None
     try:
-        result = subprocess.run(
-            [cmux, "clear-status", "intent"],
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+        return _open_hook_agent_socket(path)
+    except OSError:
+        return None
 
 
-def set_attention_status(cmux: str, message: str) -> bool:
-    """Show attention indicator in sidebar with bell icon."""
-    cmd = [cmux, "set-status", "attention", message, "--icon", "bell.fill"]
+def _close_hook_agent(sock) -> None:
+    """Close a broken agent connection so the next request reconnects."""
+    sock.close()
+    _connect_hook_agent.cache_clear()
+
+
+def send_to_hook_agent(ops: list[list[str]], ack: bool = True) -> bool:
+    """Send cmux commands to the hook agent as one request.
+
+    The request is one JSON line, {"ops": [{"args": [...]}, ...]}; the agent
+    answers "ok" as soon as it has read it, before running the ops. Any
+    other reply counts as not delivered, so callers fall back to running
+    cmux. Once the request is written a slow reply still counts as
+    delivered, so the ops never run twice. With ack=False the request
+    carries "ack": false and nothing is awaited.
+    """
+    sock = _connect_hook_agent()
+    if sock is None:
+        return False
+    message = {"ops": [_op_message(op) for op in ops]}
+    if not ack:
+        message["ack"] = False
     try:
-        result = subprocess.run(
-            cmd,
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
+        sock.sendall(json_dumps(message) + b"\n")
+    except OSError:
+        _close_hook_agent(sock)
         return False
+    if not ack:
+        return True
 
+    reply = b""
+    try:
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            reply += chunk
+    except socket.timeout:
+        # The agent has the request; drop the connection so its late
+        # reply is not read as the answer to the next one.
+        _close_hook_agent(sock)
+        return True
+    except OSError:
+        reply = b""
+    if reply.strip() == b"ok":
+        return True
+    _close_hook_agent(sock)
+    return False
+
+
+def stop_hook_agent() -> None:
+    """Ask the workspace's hook agent to exit and remove its socket.
 
-def clear_attention_status(cmux: str) -> bool:
-    """Clear attention indicator from sidebar."""
+    Shutdown goes over a fresh connection. The socket file is removed only
+    once the shutdown was delivered or nothing is listening on it, so a
+    running agent is never left unreachable.
+    """
+    path = hook_agent_socket_path()
+    if not path:
+        return
+    if _connect_hook_agent.cache_info().currsize:
+        sock = _connect_hook_agent()
+        if sock is not None:
+            _close_hook_agent(sock)
+    try:
+        sock = _open_hook_agent_socket(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass  # no agent is listening; the socket file is stale
+    except OSError:
+        return
+    else:
+        try:
+            sock.sendall(json_dumps({"shutdown": True}) + b"\n")
+        except OSError:
+            return
+        finally:
+            sock.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def ensure_hook_agent(cmux: str) -> None:
+    """Start `cmux hook-agent` for this workspace unless one is already listening.
+
+    Commands fall back to spawning cmux directly until the agent is up.
+    """
+    path = hook_agent_socket_path()
+    if not path or _connect_hook_agent() is not None:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    _spawn_detached([cmux, "hook-agent", "--socket", path])
+
+
+def _run_cmux_detached(cmux: str, ops: list[list[str]]) -> bool:
+    """Fire-and-forget independent status ops: one unacknowledged agent request,
+    or one detached cmux process per op."""
+    if send_to_hook_agent(ops, ack=False):
+        return True
+    ok = True
+    for op in ops:
+        ok = _spawn_detached([cmux, *op], input=_op_stdin(op).decode()) and ok
+    return ok
+
+
+def set_attention_status(cmux: str, message: str) -> bool:
+    """Show attention indicator in sidebar with bell icon."""
+    args = ["set-status", "attention", message, "--icon", "bell.fill"]
+    if send_to_hook_agent([args]):
+        return True
     try:
         result = subprocess.run(
-            [cmux, "clear-status", "attention"],
+            [cmux, *args],
             check=False,
-            capture_output=True,
-            text=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
             timeout=3,
         )
         return result.returncode == 0
@@ -235,124 +542,212 @@ def clear_attention_status(cmux: str) -> bool:
 
 
 def set_running_status(cmux: str) -> bool:
-    """Show green running indicator in sidebar."""
-    cmd = [cmux, "set-status", "running", "Running", "--color", "#34c759", "--icon", "bolt.fill"]
-    try:
-        result = subprocess.run(
-            cmd, check=False, capture_output=True, text=True, timeout=3
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+    """Clear attention indicator and show green running indicator in sidebar."""
+    return _run_cmux_detached(cmux, [["clear-status", "attention"], list(RUNNING_STATUS_ARGS)])
 
 
 def clear_running_status(cmux: str) -> bool:
     """Clear running indicator from sidebar."""
-    try:
-        result = subprocess.run(
-            [cmux, "clear-status", "running"],
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+    return _run_cmux_detached(cmux, [["clear-status", "running"]])
+
+
+def run_cmux_sequence(cmux: str, ops: list[list[str]]) -> bool:
+    """Run cmux commands one after another, each to completion.
+
+    This is the fallback when the batch path is unavailable; the ops keep
+    their order, e.g. `claude-hook stop` finishes before the running
+    indicator is set.
+    """
+    ok = True
+    for op in ops:
+        try:
+            result = subprocess.run(
+                [cmux, *op],
+                input=_op_stdin(op),
+                check=False,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=3,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            ok = False
+            continue
+        ok = ok and result.returncode == 0
+    return ok
 
 
-def signal_session_start(cmux: str) -> bool:
+@functools.lru_cache(maxsize=1)
+def batch_unsupported_marker(cmux: str) -> str:
+    """Per-user marker file recording that this cmux build rejects `cmux batch`.
+
+    Keyed on the binary path and mtime, so upgrading cmux probes again.
+    """
     try:
-        result = subprocess.run(
-            [cmux, "claude-hook", "session-start"],
-            input="{}",
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
-        )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+        mtime = os.stat(cmux).st_mtime_ns
+    except OSError:
+        return ""
+    digest = hashlib.sha1(f"{cmux}\0{mtime}".encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"cmux-copilot-{os.getuid()}-nobatch-{digest}")
+
+
+def _batch_unsupported(returncode: int, stderr: bytes) -> bool:
+    return returncode == CMUX_USAGE_EXIT or bool(_UNKNOWN_COMMAND_RE.search(stderr or b""))
+
 
+def start_cmux_batch(cmux: str, ops: list[list[str]]):
+    """Submit several cmux commands in one process via `cmux batch --stdin`.
 
-def signal_session_stop(cmux: str) -> bool:
+    Each op is written as one JSON object per line: {"args": [...]}, plus
+    "stdin" for ops that read a payload (claude-hook gets "{}"). When the
+    hook agent is listening the ops are sent to it instead. The batch is
+    left open so finish_cmux_batch can append more ops to the same
+    invocation; returns the handle, or None when the ops were not
+    submitted (a cmux known to lack `batch`, or one that failed to start).
+    """
+    if send_to_hook_agent(ops):
+        return cmux, None
+    marker = batch_unsupported_marker(cmux)
+    if marker and os.path.exists(marker):
+        return None
     try:
-        result = subprocess.run(
-            [cmux, "claude-hook", "stop"],
-            input="{}",
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=3,
+        process = subprocess.Popen(
+            [cmux, "batch", "--stdin"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
         )
-        return result.returncode == 0
-    except (OSError, subprocess.TimeoutExpired):
+    except OSError:
+        return None
+    try:
+        process.stdin.write(b"".join(json_dumps(_op_message(op)) + b"\n" for op in ops))
+        process.stdin.flush()
+    except OSError:
+        pass  # cmux exited early; its status is checked in finish_cmux_batch
+    return cmux, process
+
+
+def finish_cmux_batch(batch, extra_ops=()) -> bool:
+    """Append extra_ops to a started batch, close it and wait for cmux.
+
+    Returns False only when the ops were not submitted at all, so callers
+    can fall back to run_cmux_sequence without running anything twice. A
+    failed op or a timeout still counts as submitted. A cmux that rejects
+    the subcommand is remembered in batch_unsupported_marker() and not
+    asked again.
+    """
+    if not batch:
         return False
+    cmux, process = batch
+    if process is None:
+        if extra_ops and not send_to_hook_agent(extra_ops):
+            run_cmux_sequence(cmux, extra_ops)
+        return True
+
+    script = b"".join(json_dumps(_op_message(op)) + b"\n" for op in extra_ops)
+    try:
+        _, stderr = process.communicate(script, timeout=3)
+    except subprocess.TimeoutExpired:
+        _abort_probe(process)
+        return True
+    if process.returncode == 0 or not _batch_unsupported(process.returncode, stderr):
+        return True
+    marker = batch_unsupported_marker(cmux)
+    if marker:
+        try:
+            os.close(os.open(marker, os.O_WRONLY | os.O_CREAT, 0o600))
+        except OSError:
+            pass
+    return False
 
 
-def build_workspace_title(payload: dict) -> str:
-    session_title = extract_session_title(payload)
-    project_name = extract_project_name(payload)
-    if session_title and project_name:
-        return f"{project_name} — {session_title}"
-    return project_name or session_title or ""
+def run_cmux_batch(cmux: str, ops: list[list[str]]) -> bool:
+    return finish_cmux_batch(start_cmux_batch(cmux, ops))
 
 
-def handle_session_start(payload: dict) -> None:
+def handle_session_start(payload: dict, ctx: HookCtx):
     cmux = resolve_cmux_binary()
     if not cmux:
-        return
+        return None
 
-    remove_state()
-    clear_attention_status(cmux)
-    clear_workspace_subtitle(cmux)
-    signal_session_stop(cmux)
-    set_running_status(cmux)
+    stateful = bool(get_workspace_ref())
+    if stateful:
+        remove_state()
+        ensure_hook_agent(cmux)
 
     state = {}
     state["started"] = True
 
-    title = build_workspace_title(payload)
+    ops = [
+        ["clear-status", "attention"],
+        ["clear-status", "intent"],
+        ["claude-hook", "stop"],
+        list(RUNNING_STATUS_ARGS),
+    ]
+    title = ctx.workspace_title
     if title:
-        update_workspace_title(cmux, title)
+        ops.append(["rename-workspace", title])
         state["title"] = title
 
-    write_state(state)
+    if not run_cmux_batch(cmux, ops):
+        run_cmux_sequence(cmux, ops)
+
+    if stateful:
+        write_state(state)
+    return None
 
 
-def handle_report_intent(payload: dict) -> None:
+def handle_report_intent(payload: dict, ctx: HookCtx, tool_args=None) -> None:
     cmux = resolve_cmux_binary()
     if not cmux:
         return
 
-    tool_args = extract_tool_args(payload)
+    if tool_args is None:
+        tool_args = extract_tool_args(payload)
     intent = tool_args.get("intent")
     if not isinstance(intent, str) or not intent.strip():
         return
 
-    state = read_state()
+    intent = intent.strip()
+    stateful = bool(get_workspace_ref())
+    state = read_state() if stateful else {}
+    ops = []
 
-    if not state.get("started"):
-        signal_session_stop(cmux)
-        set_running_status(cmux)
+    signal_start = not state.get("started")
+    if signal_start:
+        ops.append(["claude-hook", "stop"])
         state["started"] = True
 
-    title = build_workspace_title(payload)
-    if title and title != state.get("title"):
-        update_workspace_title(cmux, title)
+    title = ctx.workspace_title
+    rename = bool(title and stored_state_title(title) != state.get("title"))
+    if rename:
+        ops.append(["rename-workspace", title])
         state["title"] = title
 
-    clear_attention_status(cmux)
-    set_running_status(cmux)
-    write_state(state)
-    update_workspace_subtitle(cmux, intent.strip())
+    ops.extend(
+        [
+            ["clear-status", "attention"],
+            list(RUNNING_STATUS_ARGS),
+            ["set-status", "intent", intent],
+        ]
+    )
+    if not run_cmux_batch(cmux, ops):
+        run_cmux_sequence(cmux, ops)
+
+    if stateful:
+        write_state(state)
 
 
-def handle_session_end(payload: dict) -> None:
+def handle_session_end(payload: dict, ctx: HookCtx):
+    """Update the sidebar for a finished session.
+
+    The status updates are submitted first and run while the focus probes
+    finish; the end-of-session notification is then appended to the same
+    batch. It is returned only when it still has to be sent.
+    """
+    focus_check = start_focus_check()
     cmux = resolve_cmux_binary()
     if not cmux:
-        return
+        return notification_from_session_end(payload, ctx, focus_check)
 
     reason = str(payload.get("reason") or "unknown")
     if reason == "complete":
@@ -360,30 +755,80 @@ def handle_session_end(payload: dict) -> None:
     else:
         message = f"Task stopped ({reason})"
 
-    update_workspace_subtitle(cmux, message)
-    clear_attention_status(cmux)
-    clear_running_status(cmux)
-    signal_session_stop(cmux)
-    remove_state()
+    ops = [
+        ["set-status", "intent", message],
+        ["clear-status", "attention"],
+        ["clear-status", "running"],
+        ["claude-hook", "stop"],
+    ]
+    batch = start_cmux_batch(cmux, ops)
+    notification = notification_from_session_end(payload, ctx, focus_check)
+    notify_ops = [notify_args(*notification)] if notification else []
+    if finish_cmux_batch(batch, notify_ops):
+        notification = None
+    else:
+        run_cmux_sequence(cmux, ops)
+    if get_workspace_ref():
+        remove_state()
+        stop_hook_agent()
+    return notification
+
 
+FRONTMOST_BUNDLE_SCRIPT = (
+    'tell application "System Events" to get bundle identifier of first process whose frontmost is true'
+)
 
-def is_caller_surface_focused(cmux: str) -> bool:
+
+def _start_probe(cmd: list[str]):
+    """Launch a query command without waiting; returns the Popen or None."""
     try:
-        result = subprocess.run(
-            [cmux, "identify", "--json"],
-            check=False,
-            capture_output=True,
+        return subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=2,
         )
-    except (OSError, subprocess.TimeoutExpired):
-        return False
+    except OSError:
+        return None
+
+
+def _finish_probe(process, deadline: float) -> str:
+    """Collect stdout of a probe by deadline; returns "" on failure or timeout."""
+    try:
+        stdout, _ = process.communicate(timeout=max(deadline - time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        _abort_probe(process)
+        return ""
+    return stdout if process.returncode == 0 else ""
+
+
+def _abort_probe(process) -> None:
+    process.kill()
+    process.communicate()
+
+
+def _start_identify_probe(cmux: str):
+    return _start_probe([cmux, "identify", "--json"])
+
+
+def _start_frontmost_probe():
+    osascript = resolve_osascript_binary()
+    if not osascript or not _expected_bundle_id():
+        return None
+    return _start_probe([osascript, "-e", FRONTMOST_BUNDLE_SCRIPT])
 
-    if result.returncode != 0 or not result.stdout.strip():
+
+def _expected_bundle_id() -> str:
+    return (os.environ.get("CMUX_BUNDLE_ID") or "com.cmuxterm.app").strip()
+
+
+def _is_caller_surface(identify_output: str) -> bool:
+    if not identify_output.strip():
         return False
 
     try:
-        data = json.loads(result.stdout)
+        data = json_loads(identify_output)
     except json.JSONDecodeError:
         return False
 
@@ -409,33 +854,43 @@ def is_caller_surface_focused(cmux: str) -> bool:
     )
 
 
-def is_cmux_frontmost() -> bool:
-    osascript = shutil.which("osascript")
-    if not osascript:
-        return False
+def _is_cmux_bundle(frontmost_output: str) -> bool:
+    return frontmost_output.strip() == _expected_bundle_id()
 
-    expected_bundle = (os.environ.get("CMUX_BUNDLE_ID") or "com.cmuxterm.app").strip()
-    if not expected_bundle:
-        return False
 
-    script = 'tell application "System Events" to get bundle identifier of first process whose frontmost is true'
-    try:
-        result = subprocess.run(
-            [osascript, "-e", script],
-            check=False,
-            capture_output=True,
-            text=True,
-            timeout=2,
-        )
-    except (OSError, subprocess.TimeoutExpired):
+def start_focus_check():
+    """Launch the osascript and `cmux identify` probes concurrently.
+
+    Returns the running probe pair, or None when the check cannot succeed.
+    """
+    cmux = resolve_cmux_binary()
+    if not cmux:
+        return None
+
+    frontmost = _start_frontmost_probe()
+    if not frontmost:
+        return None
+    identify = _start_identify_probe(cmux)
+    if not identify:
+        _abort_probe(frontmost)
+        return None
+    return frontmost, identify
+
+
+def finish_focus_check(probes) -> bool:
+    if not probes:
         return False
 
-    return result.returncode == 0 and result.stdout.strip() == expected_bundle
+    frontmost, identify = probes
+    deadline = time.monotonic() + 2
+    if not _is_cmux_bundle(_finish_probe(frontmost, deadline)):
+        _abort_probe(identify)
+        return False
+    return _is_caller_surface(_finish_probe(identify, deadline))
 
 
 def is_same_cmux_surface_active() -> bool:
-    cmux = resolve_cmux_binary()
-    return bool(cmux and is_cmux_frontmost() and is_caller_surface_focused(cmux))
+    return finish_focus_check(start_focus_check())
 
 
 def extract_tool_name(payload: dict) -> str:
@@ -453,7 +908,7 @@ def extract_tool_args(payload: dict) -> dict:
             return value
         if isinstance(value, str) and value.strip():
             try:
-                parsed = json.loads(value)
+                parsed = json_loads(value)
             except json.JSONDecodeError:
                 continue
             if isinstance(parsed, dict):
@@ -484,10 +939,14 @@ def extract_summary_hint(tool_args: dict) -> str:
     if not isinstance(summary, str):
         return ""
 
-    for line in summary.splitlines():
-        candidate = line.strip().lstrip("-* ").strip()
+    start, end = 0, len(summary)
+    while start < end:
+        line_break = _LINE_BREAK_RE.search(summary, start)
+        stop = line_break.start() if line_break else end
+        candidate = summary[start:stop].strip().lstrip("-* ").strip()
         if candidate:
             return normalize_body(candidate)
+        start = stop + 1
     return ""
 
 
@@ -528,9 +987,11 @@ def build_interaction_body(tool_name: str, tool_args: dict) -> str:
     return "Copilot needs your input."
 
 
-def notification_from_tool_use(payload: dict):
-    tool_name = extract_tool_name(payload)
-    tool_args = extract_tool_args(payload)
+def notification_from_tool_use(payload: dict, ctx: HookCtx, tool_name=None, tool_args=None):
+    if tool_name is None:
+        tool_name = extract_tool_name(payload)
+    if tool_args is None:
+        tool_args = extract_tool_args(payload)
     if not is_interactive_tool_use(tool_name, tool_args):
         return None
 
@@ -543,12 +1004,12 @@ def notification_from_tool_use(payload: dict):
         return None
 
     body = build_interaction_body(tool_name, tool_args)
-    subtitle = build_context_subtitle(payload) or default_interaction_subtitle(tool_name)
+    subtitle = ctx.context_subtitle or default_interaction_subtitle(tool_name)
     return ("Copilot CLI", subtitle, body)
 
 
-def notification_from_session_end(payload: dict):
-    if is_same_cmux_surface_active():
+def notification_from_session_end(payload: dict, ctx: HookCtx, focus_check):
+    if finish_focus_check(focus_check):
         return None
 
     reason = str(payload.get("reason") or "unknown")
@@ -556,61 +1017,84 @@ def notification_from_session_end(payload: dict):
         body = "Task finished."
     else:
         body = f"Task stopped ({reason})."
-    subtitle = build_context_subtitle(payload) or "Session ended"
+    subtitle = ctx.context_subtitle or "Session ended"
     return ("Copilot CLI", subtitle, body)
 
 
-def build_notification(event_name: str, payload: dict):
-    if event_name in ("preToolUse", "postToolUse"):
-        return notification_from_tool_use(payload)
-    if event_name == "sessionEnd":
-        return notification_from_session_end(payload)
-    return None
+# Strings are passed as argv so they never need AppleScript escaping.
+NOTIFICATION_SCRIPT = """on run argv
+    display notification (item 1 of argv) with title (item 2 of argv) subtitle (item 3 of argv)
+end run"""
+
+
+def notify_args(title: str, subtitle: str, body: str) -> list[str]:
+    args = ["notify", "--title", title]
+    if subtitle:
+        args.extend(["--subtitle", subtitle])
+    if body:
+        args.extend(["--body", body])
+    return args
 
 
 def notify(title: str, subtitle: str, body: str) -> None:
     cmux = resolve_cmux_binary()
     if cmux:
-        command = [cmux, "notify", "--title", title]
-        if subtitle:
-            command.extend(["--subtitle", subtitle])
-        if body:
-            command.extend(["--body", body])
         try:
-            result = subprocess.run(command, check=False, timeout=3)
+            result = subprocess.run(
+                [cmux, *notify_args(title, subtitle, body)],
+                check=False,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=3,
+            )
         except (OSError, subprocess.TimeoutExpired):
             result = None
         if result and result.returncode == 0:
             return
 
-    osascript = shutil.which("osascript")
+    osascript = resolve_osascript_binary()
     if osascript:
-        script = f"display notification {json.dumps(body)} with title {json.dumps(title)}"
-        if subtitle:
-            script += f" subtitle {json.dumps(subtitle)}"
-        subprocess.run([osascript, "-e", script], check=False)
+        subprocess.run(
+            [osascript, "-e", NOTIFICATION_SCRIPT, body, title, subtitle],
+            check=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+# Session handlers take (payload, ctx) and return the notification that
+# main still has to send, as a (title, subtitle, body) tuple, or None.
+EVENT_DISPATCH = {
+    "sessionStart": handle_session_start,
+    "sessionEnd": handle_session_end,
+}
+HANDLED_EVENTS = TOOL_EVENTS | frozenset(EVENT_DISPATCH)
 
 
 def main() -> int:
     event_name = sys.argv[1] if len(sys.argv) > 1 else ""
+    if event_name not in HANDLED_EVENTS:
+        return 0
+
     payload = parse_hook_payload()
+    ctx = HookCtx(payload)
 
-    if event_name in ("preToolUse", "postToolUse"):
+    if event_name in TOOL_EVENTS:
         tool_name = extract_tool_name(payload)
         tool_args = extract_tool_args(payload)
+        interactive = is_interactive_tool_use(tool_name, tool_args)
         if tool_name == "report_intent":
-            handle_report_intent(payload)
-        elif not is_interactive_tool_use(tool_name, tool_args):
+            handle_report_intent(payload, ctx, tool_args)
+        elif not interactive:
             cmux = resolve_cmux_binary()
             if cmux:
-                clear_attention_status(cmux)
                 set_running_status(cmux)
-    elif event_name == "sessionStart":
-        handle_session_start(payload)
-    elif event_name == "sessionEnd":
-        handle_session_end(payload)
+        if not interactive:
+            return 0
+        notification = notification_from_tool_use(payload, ctx, tool_name, tool_args)
+    else:
+        notification = EVENT_DISPATCH[event_name](payload, ctx)
 
-    notification = build_notification(event_name, payload)
     if not notification:
         return 0
     notify(*notification)